@@ -1,7 +1,10 @@
 import os
+import csv
+import logging
 import pandas as pd
 import matplotlib.pyplot as plt
-from lecroyparser import ScopeData
+from trc_reader import (cache_path, csv_value, load_cache, parse_trc, prefetch, read_bytes,
+                        read_trc, save_cache)
 from tqdm import tqdm
 
 # Define the directory containing your pressure .trc files
@@ -11,25 +14,39 @@ data_dir = "/share/blondin/jrfloren/data/raw/pfrc/data/20200309/pressure/"
 trc_files = [f for f in os.listdir(data_dir) if f.endswith(".trc")]
 print(f"Found {len(trc_files)} .trc files in {data_dir}")
 
-def process_trc_file(file_path, sparse=None):
+# Per-file messages go to a log file rather than the terminal, so they
+# don't interleave with the progress bar
+log_path = os.path.join(data_dir, "exploratory_analysis.log")
+logging.basicConfig(filename=log_path, level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+def process_trc_file(file_path, sparse=None, data=None):
     """
-    Processes a Lecroy .trc file using lecroyparser.
-    Optionally, the 'sparse' parameter limits the number of samples.
+    Processes a Lecroy .trc file using the memory-mapped reader in trc_reader.
+    Optionally, the 'sparse' parameter limits the number of samples, and
+    'data' supplies the file contents if they were already read (prefetched).
     
     Returns:
       A DataFrame with columns 'time' and 'amplitude' or None on error.
     """
+    # Parsed waveforms are cached next to the .trc file (the same cache
+    # tda_analysis.py uses), so later runs can skip parsing entirely.
+    npz_path = cache_path(file_path, sparse)
     try:
-        # Create a ScopeData object.
+        cached = load_cache(npz_path)
+        if cached is not None:
+            return pd.DataFrame({'time': cached[0], 'amplitude': cached[1]})
+
+        # Extract time and waveform data.
         # If you want to limit the number of samples, pass the sparse parameter.
-        if sparse:
-            data = ScopeData(file_path, parseAll=False, sparse=sparse)
+        if data is not None:
+            time, waveform = parse_trc(data, sparse=sparse)
         else:
-            data = ScopeData(file_path)
-        
-        # Extract time and waveform data (attributes 'x' and 'y')
-        time = data.x  # timebase array
-        waveform = data.y  # waveform (amplitude) array
+            time, waveform = read_trc(file_path, sparse=sparse)
+        try:
+            save_cache(npz_path, time, waveform)
+        except OSError as e:
+            logging.warning(f"Could not cache waveform to {npz_path}: {e}")
 
         # Create a DataFrame
         df = pd.DataFrame({
@@ -38,7 +55,7 @@ def process_trc_file(file_path, sparse=None):
         })
         return df
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
+        logging.error(f"Error processing {file_path}: {e}")
         return None
 
 # Process a single sample file and plot its waveform
@@ -58,25 +75,46 @@ if trc_files:
         print("Sample statistics:")
         print(sample_df.describe())
     else:
-        print("Could not load sample file.")
+        print(f"Could not load sample file; see {log_path}")
 
 # Create a directory to store statistics, if desired
 stats_dir = os.path.join(data_dir, "stats")
 os.makedirs(stats_dir, exist_ok=True)
 
-# Iterate over all files, process them, and compute basic stats
+def read_uncached(file_path, sparse=1000):
+    """Prefetch a file's bytes, unless its parsed waveform is already cached."""
+    return None if os.path.exists(cache_path(file_path, sparse)) else read_bytes(file_path)
+
+# Iterate over all files, process them, and compute basic stats. Upcoming
+# files are read on background threads while the current one is processed.
 all_stats = {}
+all_rows = []
 print("\nProcessing all .trc files for descriptive statistics:")
-for filename in tqdm(trc_files):
-    full_path = os.path.join(data_dir, filename)
-    df = process_trc_file(full_path, sparse=1000)  # adjust sparse as needed
+full_paths = [os.path.join(data_dir, filename) for filename in trc_files]
+for full_path, data in tqdm(prefetch(full_paths, read=read_uncached), total=len(full_paths)):
+    filename = os.path.basename(full_path)
+    df = process_trc_file(full_path, sparse=1000, data=data)  # adjust sparse as needed
     if df is not None:
         stats = df.describe()
         all_stats[filename] = stats
-        # Save the statistics to a CSV file for future reference
-        stats_filename = filename.replace('.trc', '_stats.csv')
-        stats.to_csv(os.path.join(stats_dir, stats_filename))
+        # One row per file, with columns such as 'amplitude_mean'
+        all_rows.append({'file': filename,
+                         **{f"{column}_{stat}": value
+                            for (column, stat), value in stats.unstack().items()}})
     else:
-        print(f"Skipping file: {filename}")
+        logging.warning(f"Skipping file: {filename}")
+        tqdm.write(f"Skipping file: {filename}")
+
+# Save the statistics for all files to a single CSV for future reference,
+# writing rows directly into one 1 MiB write buffer. csv.writer quotes file
+# names containing commas or quotes, as pandas' to_csv would.
+all_stats_path = os.path.join(stats_dir, "all_stats.csv")
+with open(all_stats_path, 'w', buffering=1 << 20, newline='') as f:
+    if all_rows:
+        columns = list(all_rows[0])
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows([csv_value(row[c]) for c in columns] for row in all_rows)
+print(f"Saved statistics for {len(all_rows)} files to {all_stats_path}")
 
 print("\nExploratory analysis complete.")
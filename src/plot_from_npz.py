@@ -0,0 +1,30 @@
+import os
+import sys
+import matplotlib
+matplotlib.use("Agg")
+from tda_analysis import load_diagrams, plots_dir, save_diagram_plot
+
+# Render persistence diagram PNGs from the *_dgms.npz files written by
+# tda_analysis.py. Pass specific .npz files on the command line, or none to
+# render every diagram saved in plots_dir.
+#
+#   python src/plot_from_npz.py [path/to/C1--pressure--00006_dgms.npz ...]
+
+def render_npz(npz_filename):
+    """
+    Render one saved set of persistence diagrams to a PNG next to it.
+
+    Returns:
+      str: Path of the PNG file written.
+    """
+    base_name = os.path.basename(npz_filename).replace('_dgms.npz', '')
+    plot_filename = os.path.join(os.path.dirname(npz_filename), f"{base_name}_tda.png")
+    save_diagram_plot(load_diagrams(npz_filename), base_name, plot_filename)
+    return plot_filename
+
+if __name__ == "__main__":
+    npz_files = sys.argv[1:] or sorted(os.path.join(plots_dir, f) for f in os.listdir(plots_dir)
+                                       if f.endswith("_dgms.npz"))
+    print(f"Rendering {len(npz_files)} persistence diagrams")
+    for npz_filename in npz_files:
+        print(f"Saved TDA plot to {render_npz(npz_filename)}")
@@ -1,12 +1,25 @@
 import os
+# Files are analyzed in parallel worker processes, one file per core; keep
+# BLAS/OpenMP single-threaded so the workers don't oversubscribe the CPU
+# (it is read at import, so this must precede numpy). Numba's thread pool
+# starts lazily, so _init_worker caps it in the workers only.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from lecroyparser import ScopeData
+from trc_reader import cache_path, csv_value, load_cache, read_trc, save_cache
+from scipy.spatial.distance import pdist
 from ripser import ripser
 from persim import plot_diagrams
 from tqdm import tqdm
 
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:  # numba is optional; delay_embedding falls back to NumPy
+    njit = None
+
 # Set directories (adjust paths as needed)
 raw_dir = "/share/blondin/jrfloren/data/raw/pfrc/data/20200309/pressure/"
 # Create an output directory for TDA analysis within processed data:
@@ -15,52 +28,200 @@ stats_dir = os.path.join(output_dir, "stats")
 plots_dir = os.path.join(output_dir, "plots")
 os.makedirs(stats_dir, exist_ok=True)
 os.makedirs(plots_dir, exist_ok=True)
+# Per-file messages go to a log file rather than the terminal, so they
+# don't interleave with the progress bar
+log_path = os.path.join(output_dir, "tda.log")
+
+def _configure_logging():
+    """Send INFO-level messages to log_path (no-op if already configured)."""
+    logging.basicConfig(filename=log_path, level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
 
-def process_trc_file(file_path, sparse=None):
+def load_trc(file_path, sparse=None):
     """
-    Process a Lecroy .trc file using lecroyparser.
+    Load a Lecroy .trc file using the memory-mapped reader in trc_reader.
     
     Parameters:
       file_path (str): Path to the .trc file.
       sparse (int): Optional parameter to limit the number of samples.
       
     Returns:
-      DataFrame: A pandas DataFrame with 'time' and 'amplitude' columns,
-                 or None if an error occurs.
+      tuple: (time, amplitude) NumPy arrays, or None if an error occurs.
     """
+    # Parsed waveforms are cached next to the .trc file, so later runs can
+    # skip parsing entirely.
+    npz_path = cache_path(file_path, sparse)
     try:
-        # Create a ScopeData object; if sparse is provided, limit samples.
-        data = ScopeData(file_path, parseAll=False, sparse=sparse) if sparse else ScopeData(file_path)
-        # Extract time and waveform data
-        df = pd.DataFrame({
-            'time': data.x,
-            'amplitude': data.y
-        })
-        return df
+        cached = load_cache(npz_path)
+        if cached is not None:
+            return cached
+        # If sparse is provided, limit samples.
+        x, y = read_trc(file_path, sparse=sparse)
+        try:
+            save_cache(npz_path, x, y)
+        except OSError as e:
+            logging.warning(f"Could not cache waveform to {npz_path}: {e}")
+        return x, y
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
+        logging.error(f"Error processing {file_path}: {e}")
         return None
 
-def delay_embedding(time_series, dimension=3, delay=10):
+if njit is not None:
+    @njit(cache=True)
+    def _moments(values):
+        """Shifted sum, sum of squares, min and max of values in one pass."""
+        shift = float(values[0])
+        total = 0.0
+        total_sq = 0.0
+        lo = values[0]
+        hi = values[0]
+        for v in values:
+            d = float(v) - shift
+            total += d
+            total_sq += d * d
+            if v < lo:
+                lo = v
+            elif v > hi:
+                hi = v
+        return shift, total, total_sq, lo, hi
+else:
+    def _moments(values):
+        """Shifted sum, sum of squares, min and max of values (NumPy fallback)."""
+        shift = float(values[0])
+        d = values.astype(np.float64) - shift
+        return shift, d.sum(), d @ d, values.min(), values.max()
+
+def _quantiles(values, qs):
+    """Linearly interpolated quantiles, using one np.partition instead of a full sort."""
+    pos = np.asarray(qs) * (values.size - 1)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, values.size - 1)
+    part = np.partition(values, np.unique(np.concatenate((lo, hi))))
+    return part[lo] + (part[hi] - part[lo]) * (pos - lo)
+
+def _describe(values):
+    """
+    Descriptive statistics of a 1D array, matching pandas' describe() fields
+    (std uses ddof=1, quantiles interpolate linearly). Assumes finite
+    values: unlike pandas, NaNs are not skipped. An empty array gives a
+    count of 0 and NaN for every other field, as pandas does.
+    """
+    # Sums are taken about the first sample in float64, so the mean and
+    # variance stay accurate without a separate pass over the data.
+    n = values.size
+    if n == 0:
+        return {'count': 0.0, **dict.fromkeys(['mean', 'std', 'min', '25%', '50%', '75%', 'max'], np.nan)}
+    shift, total, total_sq, lo, hi = _moments(values)
+    var = (total_sq - total * total / n) / (n - 1) if n > 1 else np.nan
+    q25, q50, q75 = _quantiles(values, [0.25, 0.5, 0.75])
+    return {
+        'count': float(n),
+        'mean': float(shift + total / n),
+        'std': float(np.sqrt(max(var, 0.0))),
+        'min': float(lo),
+        '25%': float(q25),
+        '50%': float(q50),
+        '75%': float(q75),
+        'max': float(hi),
+    }
+
+def _describe_cols(points, columns):
+    """
+    Per-column descriptive statistics of a 2D array, keyed by column name,
+    with the same fields as _describe(). Each statistic is one vectorized
+    reduction over axis 0, covering all columns at once.
+    """
+    n = points.shape[0]
+    mean = points.mean(axis=0, dtype=np.float64)
+    std = points.std(axis=0, ddof=1, dtype=np.float64) if n > 1 else np.full(points.shape[1], np.nan)
+    q25, q50, q75 = np.quantile(points, [0.25, 0.5, 0.75], axis=0)
+    fields = {'count': np.full(points.shape[1], n), 'mean': mean, 'std': std,
+              'min': points.min(axis=0), '25%': q25, '50%': q50, '75%': q75,
+              'max': points.max(axis=0)}
+    return {name: {field: float(values[i]) for field, values in fields.items()}
+            for i, name in enumerate(columns)}
+
+# Below this many embedded points the stride-tricks view is cheaper than a
+# compiled copy, so the Numba kernel is only used for long waveforms. The
+# script's own call (dimension=3 with a dtype) takes the specialized path in
+# delay_embedding and never reaches this kernel; it serves other dimensions.
+NUMBA_MIN_POINTS = 100_000
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _embed_numba(ts, dimension, delay, out):
+        for i in prange(out.shape[0]):
+            for j in range(dimension):
+                out[i, j] = ts[i * delay + j]
+
+def delay_embedding(time_series, dimension=3, delay=10, dtype=None):
     """
     Perform a delay (Takens) embedding on a 1D time series.
     
     Parameters:
       time_series (np.array): 1D array of data.
       dimension (int): Embedding dimension.
-      delay (int): Delay (in samples) between coordinates.
+      delay (int): Spacing (in samples) between the starts of successive points.
+      dtype (np.dtype): Optional output dtype. When given, the embedding is
+                        written into a new C-contiguous array of this dtype.
       
     Returns:
-      np.array: Embedded point cloud of shape (n_points, dimension).
+      np.array: Embedded point cloud of shape (n_points, dimension), where
+                row k is (x[k*delay], x[k*delay + 1], ..., x[k*delay + dimension-1]),
+                for every k*delay < len(x) - (dimension-1)*delay.
+                Without dtype, short series get a read-only view into
+                time_series. Long series (NUMBA_MIN_POINTS and up) are always
+                copied by a compiled Numba kernel, when Numba is installed.
     """
     n = len(time_series)
-    if n - (dimension - 1) * delay <= 0:
+    span = n - (dimension - 1) * delay
+    if span <= 0:
         raise ValueError("Time series is too short for the given dimension and delay")
-    embedded = np.array([time_series[i : n - (dimension - 1) * delay + i : delay] 
-                         for i in range(dimension)]).T
-    return embedded
+    ts = np.ascontiguousarray(time_series)
+    shape = ((span + delay - 1) // delay, dimension)
+    if dimension == 3 and dtype is not None:
+        # Specialized for the embedding this script always uses: three
+        # strided column copies straight into the output, no general loop.
+        m = shape[0]
+        out = np.empty(shape, dtype=dtype)
+        np.copyto(out[:, 0], ts[0:m * delay:delay], casting='same_kind')
+        np.copyto(out[:, 1], ts[1:m * delay + 1:delay], casting='same_kind')
+        np.copyto(out[:, 2], ts[2:m * delay + 2:delay], casting='same_kind')
+        return out
+    if njit is not None and shape[0] >= NUMBA_MIN_POINTS:
+        out = np.empty(shape, dtype=ts.dtype if dtype is None else dtype)
+        _embed_numba(ts, dimension, delay, out)
+        return out
+    # Each window of `dimension` consecutive samples is one embedding vector;
+    # taking every delay-th window gives the points without copying any data.
+    embedded = np.lib.stride_tricks.sliding_window_view(ts, dimension)[:span:delay]
+    if dtype is None:
+        return embedded
+    out = np.empty(shape, dtype=dtype)
+    np.copyto(out, embedded, casting='same_kind')
+    return out
 
-def analyze_file_tda(file_path, embedding_dim=3, delay=10, sparse=1000):
+def distance_threshold(points, percentile=50, sample_size=1000):
+    """
+    Estimate a Rips filtration cutoff from the pairwise distances of a point cloud.
+    
+    Parameters:
+      points (np.array): Point cloud of shape (n_points, dimension).
+      percentile (float): Percentile of the pairwise distances to return.
+      sample_size (int): Number of evenly spaced points used for the estimate,
+                         so the cost does not grow quadratically with n_points.
+      
+    Returns:
+      float: The requested percentile of the sampled pairwise distances.
+    """
+    step = max(1, len(points) // sample_size)
+    sample = points[::step]
+    if len(sample) < 2:
+        return np.inf
+    return float(np.percentile(pdist(sample), percentile))
+
+def analyze_file_tda(file_path, embedding_dim=3, delay=10, sparse=1000,
+                     maxdim=1, n_perm=2000, thresh_percentile=None):
     """
     Process a .trc file, create a delay embedding from the amplitude,
     compute persistent homology, and return the persistence diagrams and statistics.
@@ -70,67 +231,143 @@ def analyze_file_tda(file_path, embedding_dim=3, delay=10, sparse=1000):
       embedding_dim (int): Embedding dimension for delay embedding.
       delay (int): Delay (in samples) for embedding.
       sparse (int): Optional sample limit.
+      maxdim (int): Maximum homology dimension computed by ripser.
+      n_perm (int): Size of the greedy subsample ripser works on; None uses
+                    every embedded point.
+      thresh_percentile (float): Optionally stop the filtration at this
+                                 percentile of the pairwise distances. Off by
+                                 default: a cutoff below the death of the main
+                                 H1 loop reports it as never dying.
       
     Returns:
       dict: A dictionary containing:
             - 'diagrams': the persistence diagrams from ripser.
-            - 'raw_stats': descriptive statistics of the raw amplitude time-series.
-            - 'embedded_stats': descriptive statistics of the embedded point cloud.
+            - 'raw_stats': descriptive statistics of the raw amplitude time-series (dict).
+            - 'embedded_stats': descriptive statistics of the embedded point cloud
+                                (dict of per-dimension dicts).
     """
-    df = process_trc_file(file_path, sparse=sparse)
-    if df is None:
+    waveform = load_trc(file_path, sparse=sparse)
+    if waveform is None:
         return None
+    _, amplitude = waveform
     
     # Compute descriptive statistics for the raw time series
-    raw_stats = df['amplitude'].describe()
+    raw_stats = _describe(amplitude)
     
     # Delay embedding on the amplitude data
     try:
-        embedded = delay_embedding(df['amplitude'].values, dimension=embedding_dim, delay=delay)
+        # Ripser works in single precision; build the cloud directly as a
+        # contiguous float32 array rather than converting a float64 one later.
+        embedded = delay_embedding(amplitude, dimension=embedding_dim, delay=delay,
+                                   dtype=np.float32)
     except Exception as e:
-        print(f"Error creating delay embedding for {file_path}: {e}")
+        logging.error(f"Error creating delay embedding for {file_path}: {e}")
         return None
     
     # Compute descriptive statistics for the embedded point cloud
-    embedded_df = pd.DataFrame(embedded, columns=[f"dim_{i+1}" for i in range(embedding_dim)])
-    embedded_stats = embedded_df.describe()
+    embedded_stats = _describe_cols(embedded, [f"dim_{i+1}" for i in range(embedding_dim)])
     
-    # Compute persistent homology on the embedded data
-    result = ripser(embedded)
+    # Compute persistent homology on the embedded data, bounding the number
+    # of points (greedy subsampling) and, if requested, the filtration radius
+    thresh = np.inf if thresh_percentile is None else distance_threshold(embedded, thresh_percentile)
+    result = ripser(embedded, maxdim=maxdim, thresh=thresh,
+                    n_perm=None if n_perm is None else min(len(embedded), n_perm))
     diagrams = result['dgms']
     
     return {'diagrams': diagrams, 'raw_stats': raw_stats, 'embedded_stats': embedded_stats}
 
-def save_analysis_results(file_path, analysis_results):
+def write_stats_csv(path, stats_by_column):
+    """
+    Write descriptive statistics in the layout of DataFrame.describe().to_csv():
+    one column per key of stats_by_column, one row per statistic.
+    """
+    columns = list(stats_by_column)
+    fields = stats_by_column[columns[0]]
+    lines = ["," + ",".join(columns)]
+    lines += [field + "," + ",".join(csv_value(stats_by_column[c][field]) for c in columns)
+              for field in fields]
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+# One figure is reused for every persistence diagram a process saves;
+# creating it lazily means processes that never plot (importers, the bulk
+# run's workers) never create one.
+_diagram_fig = None
+
+def _diagram_figure():
+    """Return the shared (figure, axes) pair, creating it on first use."""
+    global _diagram_fig
+    if _diagram_fig is None:
+        _diagram_fig, _ = plt.subplots(figsize=(8, 4))
+    return _diagram_fig, _diagram_fig.axes[0]
+
+def save_diagram_plot(diagrams, base_name, plot_filename):
+    """Render persistence diagrams to a PNG, redrawing the shared figure."""
+    fig, ax = _diagram_figure()
+    ax.clear()
+    plot_diagrams(diagrams, ax=ax, show=False)
+    ax.set_title(f"Persistence Diagram for {base_name}")
+    fig.tight_layout()
+    fig.savefig(plot_filename)
+
+def load_diagrams(npz_filename):
+    """Load persistence diagrams saved by save_analysis_results, in H0, H1, ... order."""
+    with np.load(npz_filename) as saved:
+        return [saved[f"arr_{i}"] for i in range(len(saved.files))]
+
+def save_analysis_results(file_path, analysis_results, plot=True):
     """
     Save the analysis results:
-      - Persistence diagram plot as a PNG file.
+      - Persistence diagrams as a compressed .npz file (one array per
+        homology dimension), and optionally as a PNG plot.
       - Descriptive statistics for raw and embedded data as CSV files.
-    Filenames are based on the original .trc filename.
+    Filenames are based on the original .trc filename. PNGs for diagrams
+    saved with plot=False can be rendered later with plot_from_npz.py.
     """
     base_name = os.path.basename(file_path).replace('.trc', '')
     
+    # Save the persistence diagrams themselves
+    diagrams_filename = os.path.join(plots_dir, f"{base_name}_dgms.npz")
+    np.savez_compressed(diagrams_filename, *analysis_results['diagrams'])
+    logging.info(f"Saved persistence diagrams to {diagrams_filename}")
+    
     # Save persistence diagram plot
-    plt.figure(figsize=(8, 4))
-    plot_diagrams(analysis_results['diagrams'], show=False)
-    plot_filename = os.path.join(plots_dir, f"{base_name}_tda.png")
-    plt.title(f"Persistence Diagram for {base_name}")
-    plt.tight_layout()
-    plt.savefig(plot_filename)
-    plt.close()
-    print(f"Saved TDA plot to {plot_filename}")
+    if plot:
+        plot_filename = os.path.join(plots_dir, f"{base_name}_tda.png")
+        save_diagram_plot(analysis_results['diagrams'], base_name, plot_filename)
+        logging.info(f"Saved TDA plot to {plot_filename}")
     
     # Save raw descriptive statistics
     raw_stats_filename = os.path.join(stats_dir, f"{base_name}_raw_stats.csv")
-    analysis_results['raw_stats'].to_csv(raw_stats_filename)
-    print(f"Saved raw stats to {raw_stats_filename}")
+    write_stats_csv(raw_stats_filename, {'amplitude': analysis_results['raw_stats']})
+    logging.info(f"Saved raw stats to {raw_stats_filename}")
     
     # Save embedded descriptive statistics
     embedded_stats_filename = os.path.join(stats_dir, f"{base_name}_embedded_stats.csv")
-    analysis_results['embedded_stats'].to_csv(embedded_stats_filename)
-    print(f"Saved embedded stats to {embedded_stats_filename}")
+    write_stats_csv(embedded_stats_filename, analysis_results['embedded_stats'])
+    logging.info(f"Saved embedded stats to {embedded_stats_filename}")
+
+def _init_worker():
+    """Pool initializer: workers never open a window, so keep matplotlib on Agg."""
+    matplotlib.use("Agg")
+    if njit is not None:
+        set_num_threads(1)
+    _configure_logging()
+
+def _worker(file_path):
+    """Analyze and save a single file inside a worker process."""
+    results = analyze_file_tda(file_path, embedding_dim=3, delay=10, sparse=1000)
+    if results:
+        # PNG encoding costs more than ripser on these diagrams, so the bulk
+        # run only keeps the .npz; render plots later with plot_from_npz.py
+        save_analysis_results(file_path, results, plot=False)
+    return results is not None
 
 if __name__ == "__main__":
+    # Plots are only ever saved to files (plt.show() is never called), so
+    # render the sample's PNG with Agg rather than setting up a GUI backend.
+    matplotlib.use("Agg")
+    _configure_logging()
     # Get list of all .trc files in the raw directory
     trc_files = [os.path.join(raw_dir, f) for f in os.listdir(raw_dir) if f.endswith(".trc")]
     print(f"Found {len(trc_files)} .trc files in {raw_dir}")
@@ -143,10 +380,13 @@ if __name__ == "__main__":
     if analysis_results:
         save_analysis_results(sample_file, analysis_results)
     else:
-        print("Sample analysis failed.")
+        print(f"Sample analysis failed; see {log_path}")
     
-    # Optionally, iterate over all files
-    for file in tqdm(trc_files, desc="Processing TRC files for TDA"):
-        results = analyze_file_tda(file, embedding_dim=3, delay=10, sparse=1000)
-        if results:
-            save_analysis_results(file, results)
+    # Optionally, iterate over all files; each file is independent, so
+    # spread them across all cores.
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as executor:
+        results = executor.map(_worker, trc_files)
+        for file, ok in tqdm(zip(trc_files, results), total=len(trc_files),
+                             desc="Processing TRC files for TDA"):
+            if not ok:
+                tqdm.write(f"Failed to analyze {file}; see {log_path}")
@@ -0,0 +1,206 @@
+import mmap
+import os
+import struct
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Byte offsets of the WAVEDESC fields we need, relative to the start of the
+# WAVEDESC block (see the LeCroy Remote Control Manual, or lecroyparser).
+COMM_TYPE = 32          # 0: samples are int8, 1: int16
+COMM_ORDER = 34         # 0: big endian, 1: little endian
+WAVE_DESCRIPTOR = 36    # length of the WAVEDESC block
+USER_TEXT = 40          # length of the USERTEXT block
+TRIGTIME_ARRAY = 48     # length of the TRIGTIME array
+WAVE_ARRAY_1 = 60       # length in bytes of the sample array
+WAVE_ARRAY_COUNT = 116  # number of samples
+VERTICAL_GAIN = 156
+VERTICAL_OFFSET = 160
+HORIZ_INTERVAL = 176
+HORIZ_OFFSET = 180
+
+def _read_wavedesc(buf):
+    """
+    Unpack the WAVEDESC fields needed to locate, scale and time the samples.
+
+    Returns:
+      tuple: (start, dtype, n_samples, count, gain, offset, interval,
+              horiz_offset), where start is the byte offset of the sample
+              block and n_samples the number of stored samples.
+    """
+    base = bytes(buf[:50]).decode("ascii", "replace").index("WAVEDESC")
+    order = ">" if struct.unpack_from("<H", buf, base + COMM_ORDER)[0] == 0 else "<"
+    comm_type, = struct.unpack_from(order + "H", buf, base + COMM_TYPE)
+    wave_descriptor, user_text = struct.unpack_from(order + "ii", buf, base + WAVE_DESCRIPTOR)
+    trigtime_array, = struct.unpack_from(order + "i", buf, base + TRIGTIME_ARRAY)
+    n_bytes, = struct.unpack_from(order + "i", buf, base + WAVE_ARRAY_1)
+    count, = struct.unpack_from(order + "i", buf, base + WAVE_ARRAY_COUNT)
+    gain, offset = struct.unpack_from(order + "ff", buf, base + VERTICAL_GAIN)
+    interval, horiz_offset = struct.unpack_from(order + "fd", buf, base + HORIZ_INTERVAL)
+
+    dtype = np.dtype(order + ("i1" if comm_type == 0 else "i2"))
+    start = base + wave_descriptor + user_text + trigtime_array
+    return (start, dtype, n_bytes // dtype.itemsize, count,
+            np.float32(gain), np.float32(offset), np.float32(interval), horiz_offset)
+
+def _sample_slice(count, sparse):
+    """Basic slice picking the same samples as lecroyparser's sparse option."""
+    if not sparse:
+        return slice(0, count, 1)
+    stride = max(1, int(count / sparse))
+    return slice(0, min(count, stride * sparse), stride)
+
+def _scale(raw, keep, count, gain, offset, interval, horiz_offset):
+    """
+    Scale the kept ADC samples to amplitudes and build their timebase.
+
+    Parameters:
+      raw (np.array): Already decimated integer samples.
+      keep (slice): The slice of the full record that raw holds.
+
+    Returns:
+      tuple: (time, amplitude) NumPy arrays.
+    """
+    # Timebase values at the kept samples only, computed exactly as
+    # np.linspace(0, count * interval, num=count) would.
+    stop = count * np.float64(interval)
+    step = stop / (count - 1) if count > 1 else 0.0
+    indices = np.arange(*keep.indices(count), dtype=np.float64)
+    x = indices * step
+    if count > 1 and indices[-1] == count - 1:
+        x[-1] = stop
+    x = x + horiz_offset
+    # Scaling also copies the samples, so nothing returned keeps a reference
+    # to the source buffer.
+    y = gain * raw.astype(np.float32) - offset
+    return x, y
+
+def parse_trc(buf, sparse=None):
+    """
+    Parse a Lecroy .trc waveform from a bytes-like buffer.
+
+    Only the WAVEDESC fields needed to scale the samples and build the
+    timebase are read; the sample block is viewed in place with
+    np.frombuffer rather than copied out of the buffer.
+
+    Parameters:
+      buf (bytes-like): Contents of the .trc file (bytes, mmap, ...).
+      sparse (int): Optional number of evenly spaced samples to keep.
+
+    Returns:
+      tuple: (time, amplitude) NumPy arrays, identical to lecroyparser's
+             ScopeData(...).x and .y.
+    """
+    start, dtype, n_samples, count, *scaling = _read_wavedesc(buf)
+    keep = _sample_slice(count, sparse)
+    raw = np.frombuffer(buf, dtype=dtype, count=n_samples, offset=start)[keep]
+    return _scale(raw, keep, count, *scaling)
+
+def read_trc(file_path, sparse=None):
+    """
+    Read a Lecroy .trc file through a read-only memory map.
+
+    Parameters:
+      file_path (str): Path to the .trc file.
+      sparse (int): Optional number of evenly spaced samples to keep.
+
+    Returns:
+      tuple: (time, amplitude) NumPy arrays.
+    """
+    with open(file_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The map is unmapped when its last reference goes away; closing it
+    # explicitly would fail while an exception traceback still holds views.
+    return parse_trc(mm, sparse=sparse)
+
+def cache_path(file_path, sparse=None):
+    """Path of the .npz waveform cache for a .trc file and sparse setting."""
+    return file_path + f".s{sparse}.npz"
+
+def load_cache(npz_path):
+    """
+    Load a waveform cached by save_cache.
+
+    Returns:
+      tuple: (time, amplitude) NumPy arrays, or None if there is no cache or
+             it cannot be read (e.g. truncated), so the caller reparses.
+    """
+    if not os.path.exists(npz_path):
+        return None
+    try:
+        with np.load(npz_path) as cached:
+            return cached['x'], cached['y']
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        return None
+
+def save_cache(npz_path, x, y):
+    """
+    Cache a parsed waveform, storing the amplitude as float32.
+
+    The arrays are written to a temporary file in the same directory and
+    then moved into place, so an interrupted write never leaves a partial
+    cache behind. Raises OSError if the directory is not writable.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(npz_path) or ".",
+                                    prefix=os.path.basename(npz_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, x=x, y=np.asarray(y, dtype=np.float32))
+        os.replace(tmp_path, npz_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def csv_value(value):
+    """
+    Format a CSV cell the way pandas' to_csv does: strings as is, numbers
+    as the repr of the float, NaN as empty. Shared by the stats CSVs of
+    tda_analysis.py and exploratory_analysis.py so their formatting matches.
+    """
+    if isinstance(value, str):
+        return value
+    return "" if value != value else repr(float(value))
+
+def read_bytes(file_path):
+    """
+    Read a whole file into memory, for use with prefetch().
+
+    Returns:
+      bytes: The file contents, or None if it could not be read (the caller
+             then falls back to read_trc, which reports the error).
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def prefetch(paths, read=read_bytes, max_workers=4, lookahead=8):
+    """
+    Read files ahead of the consumer on a thread pool, so that opening and
+    reading (slow on a network filesystem) overlaps with processing.
+
+    Parameters:
+      paths (iterable): File paths, in the order they will be consumed.
+      read (callable): Called as read(path) on a worker thread.
+      max_workers (int): Number of reader threads.
+      lookahead (int): Maximum number of reads in flight or waiting.
+
+    Yields:
+      tuple: (path, result of read(path)), in the order of paths.
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(read, path)))
+            if len(pending) >= lookahead:
+                break
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, pool.submit(read, next_path)))
+            yield path, future.result()